@@ -1,9 +1,9 @@
 from __future__ import print_function, unicode_literals
 
-import _csv
-import csv
+import atexit
+import errno
+import mmap
 import os
-import shutil
 import subprocess
 import sys
 from collections import defaultdict
@@ -11,13 +11,18 @@ from collections import defaultdict
 try:
     # noinspection PyUnresolvedReferences
     from typing import (
+        AbstractSet,
         Any,
         BinaryIO,
         Callable,
         Dict,
+        FrozenSet,
         Iterable,
+        Iterator,
         List,
         Optional,
+        Sequence,
+        Set,
         Tuple,
         TypeVar,
         Union,
@@ -41,32 +46,92 @@ def git(command):
         return ret
 
 
+# Memoized git state. These answers are invariant for as long as no command moves refs
+# around, so caching them lets repeated helper calls within one CLI invocation (e.g. a
+# recursive rebase walking many children) avoid spawning a git subprocess each time. All
+# of them are dropped via clear_git_caches() whenever a mutating command runs.
+_cached_current_branch = None  # type: Optional[Text]
+_cached_git_dir = None  # type: Optional[Text]
+_rev_to_hash = {}  # type: Dict[Text, Text]
+_commit_to_containing_branches = {}  # type: Dict[Text, FrozenSet[Text]]
+
+# `git` subcommands that can't change refs or the working tree, so running them doesn't
+# require dropping our caches. `branch` is only here for its query forms (--contains and
+# --merged); the mutating forms (-d/-D) are treated as unsafe below.
+_READ_ONLY_GIT_SUBCOMMANDS = frozenset((
+    "rev-parse",
+    "merge-base",
+    "for-each-ref",
+    "diff",
+    "log",
+    "show",
+))
+
+
+def _is_read_only_git_command(command):
+    # type: (Text) -> bool
+    subcommand = command.split(" ", 1)[0]
+    if subcommand == "branch":
+        return "--contains" in command or "--merged" in command
+    return subcommand in _READ_ONLY_GIT_SUBCOMMANDS
+
+
+def clear_git_caches():
+    # type: () -> None
+    """Drops all memoized git state. Called automatically before any mutating command;
+    exposed mainly so tests can force fresh lookups."""
+    global _cached_current_branch, _cached_git_dir
+    _cached_current_branch = None
+    _cached_git_dir = None
+    _rev_to_hash.clear()
+    _commit_to_containing_branches.clear()
+    _stop_cat_file_proc()
+
+
 def get_current_branch():
     # type: () -> Text
-    return git("rev-parse --abbrev-ref HEAD").strip()
+    global _cached_current_branch
+    if _cached_current_branch is None:
+        _cached_current_branch = git("rev-parse --abbrev-ref HEAD").strip()
+    return _cached_current_branch
 
 
 def get_branch_tracker():
     # type: () -> BranchTrackerWrapper
-    git_dir = git("rev-parse --git-dir").strip()
+    global _cached_git_dir
+    if _cached_git_dir is None:
+        _cached_git_dir = git("rev-parse --git-dir").strip()
+    git_dir = _cached_git_dir
     config_dir = os.path.join(git_dir, "child_branch_helper")
-    if os.path.exists(config_dir):
-        assert os.path.isdir(config_dir)
-    else:
+    # EAFP: attempting the mkdir and tolerating EEXIST is one syscall on every run after
+    # the first, and doesn't race against anything else creating the directory.
+    try:
         os.mkdir(config_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        assert os.path.isdir(config_dir)
     config_file = os.path.join(config_dir, "branches.csv")
-    # Make sure the config file exists
-    if not os.path.exists(config_file):
-        open(config_file, "a").close()
+    # No need to ensure the file exists here; BranchTracker opens it in a mode that
+    # creates it on first use.
     return BranchTrackerWrapper(config_file)
 
 
 def does_branch_contain_commit(branch, commit):
     # type: (Text, Text) -> bool
     try:
-        return git("branch --contains {}".format(commit)).find(" {}\n".format(branch)) >= 0
-    except SystemExit:
-        return False
+        branches = _commit_to_containing_branches[commit]
+    except KeyError:
+        # Unlike `git branch --contains`, this needs no parsing around the current-branch
+        # "*" marker and can't be confused by one branch name being a suffix of another.
+        try:
+            output = git(
+                "for-each-ref --contains {} --format=%(refname:short) refs/heads".format(commit))
+        except SystemExit:
+            output = ""
+        branches = frozenset(output.splitlines())
+        _commit_to_containing_branches[commit] = branches
+    return branch in branches
 
 
 def fail_if_not_rebased(current_branch, parent, tracker):
@@ -84,6 +149,10 @@ def arc(command):
 
 def run_command_expecting_failure(command_runner, program, command):
     # type: (Callable[[List[Text]], T], Text, Text) -> T
+    if program != "git" or not _is_read_only_git_command(command):
+        # The command may move refs (or, for other programs like arc, do arbitrary things
+        # to the repo), so anything we've cached about git state may go stale.
+        clear_git_caches()
     try:
         return command_runner([program] + command.split(" "))
     except subprocess.CalledProcessError:
@@ -101,15 +170,6 @@ def run_command_expecting_failure(command_runner, program, command):
         exit(1)
 
 
-def get_csv_reader(f):
-    # type: (BinaryIO) -> _csv._reader
-    if sys.version_info[0] >= 3:
-        generator = (line.decode() for line in f)
-    else:
-        generator = (str(line) for line in f)
-    return csv.reader(generator)
-
-
 class BranchTrackerWrapper(object):
     def __init__(self, config_file):
         # type: (Text) -> None
@@ -129,34 +189,78 @@ class BranchTrackerWrapper(object):
 
 class BranchTracker(object):
     _VERSION_ROW_ID = "version"
+    # Below this size, reading the whole file at once beats setting up a memory mapping.
+    _MMAP_MIN_SIZE_BYTES = 16384
 
     def __init__(self, config_file):
         # type: (Text) -> None
         super(BranchTracker, self).__init__()
         self._config_file = config_file
         self._child_to_parent = {}  # type: Dict[Text, Text]
-        self._parent_to_children = defaultdict(list)  # type: Dict[Text, List[Text]]
-        self._branch_to_bases = {}  # type: Dict[Text, Tuple[Text, ...]]
+        # Children are kept as sets so the removals in collapse_and_remove_parent,
+        # rename_branch and set_parent are O(1) instead of scanning a list.
+        self._parent_to_children = defaultdict(set)  # type: Dict[Text, Set[Text]]
+        # Parallel dicts instead of a dict of tuples: the base is always present, the
+        # rebase base only mid-rebase, so two scalar lookups replace tuple packing and
+        # length checks.
+        self._branch_to_base = {}  # type: Dict[Text, Text]
+        self._branch_to_rebase_base = {}  # type: Dict[Text, Optional[Text]]
         self._is_branch_archived = {}  # type: Dict[Text, bool]
-        # Read config file
-        with open(config_file, "rb") as f:
+        # Set by every mutator; read-only commands leave it False so save_to_file can
+        # skip rewriting an unchanged file.
+        self._dirty = False
+        # Read config file. Append mode creates the file on first use without costing a
+        # separate existence check and touch on every later invocation; we only ever
+        # read through this handle, so seek back to the start first.
+        with open(config_file, "a+b") as f:
+            f.seek(0)
             # Run migrations as necessary. This will re-write the stored file before we read any
             # branch data from it.
             self._version = self._run_migrations(f)
-            reader = get_csv_reader(f)
-            # We don't need to handle the version row, since that'll be handled by _run_migrations
-            for row in reader:
-                child, parent, base, rebase_base, is_archived = row
+            # We don't need to handle the version row, since that'll be handled by
+            # _run_migrations. The schema is a fixed five-column row with no quoting
+            # (save_to_file asserts that no field contains a comma), so a plain split is
+            # much cheaper than running the csv state machine over every row.
+            for line in self._iter_data_lines(f):
+                if not line:
+                    continue
+                child, parent, base, rebase_base, is_archived = line.split(",")
+                # One duplicate check is enough: every dict here is populated together,
+                # so a child absent from _child_to_parent is absent from all of them.
                 assert child not in self._child_to_parent
-                assert child not in self._branch_to_bases
                 self._child_to_parent[child] = parent
-                self._parent_to_children[parent].append(child)
+                self._parent_to_children[parent].add(child)
                 self._is_branch_archived[child] = is_archived == "True"
                 assert base
-                if rebase_base:
-                    self._branch_to_bases[child] = (base, rebase_base)
-                else:
-                    self._branch_to_bases[child] = (base, )
+                self._branch_to_base[child] = base
+                self._branch_to_rebase_base[child] = rebase_base or None
+
+    def _iter_data_lines(self, f):
+        # type: (BinaryIO) -> Iterator[Text]
+        """
+        Yields the data lines of the config file, starting from f's current position.
+
+        Large files are iterated straight out of a read-only memory mapping, which avoids
+        copying the whole file into a Python string; small files (the common case) are
+        simply read in one call.
+        """
+        start = f.tell()
+        if os.fstat(f.fileno()).st_size - start > self._MMAP_MIN_SIZE_BYTES:
+            try:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # Fall through to the plain read below (e.g. filesystems that can't mmap).
+                pass
+            else:
+                try:
+                    mapping.seek(start)
+                    for raw_line in iter(mapping.readline, b""):
+                        yield raw_line.decode().rstrip("\r\n")
+                finally:
+                    mapping.close()
+                return
+        for line in f.read().decode().splitlines():
+            yield line
 
     def _run_migrations(self, f):
         # type: (BinaryIO) -> int
@@ -194,15 +298,13 @@ class BranchTracker(object):
         # type: (BinaryIO) -> int
         # If there are no rows in the file, assume we're on version 0
         version = 0
-        reader = get_csv_reader(f)
-        # We only want to look at the first line, but the easiest way to do that is a for loop with
-        # a break.
-        for version_row in reader:
-            if len(version_row) == 2:
-                version_row_id, version_str = version_row
-                assert version_row_id == self._VERSION_ROW_ID, "Version row ID doesn't match"
-                version = int(version_str)
-            break
+        # The version row follows the same no-quoting grammar as the data rows, so a
+        # plain split replaces the csv reader here too (the module's last use).
+        version_row = f.readline().decode().rstrip("\r\n").split(",")
+        if len(version_row) == 2:
+            version_row_id, version_str = version_row
+            assert version_row_id == self._VERSION_ROW_ID, "Version row ID doesn't match"
+            version = int(version_str)
 
         return version
 
@@ -228,61 +330,70 @@ class BranchTracker(object):
 
     def save_to_file(self):
         # type: () -> None
+        if not self._dirty:
+            return
         tmp_config_file = self._config_file + ".tmp"
+        # Build the whole payload up front and write it with a single call, sorted by
+        # child branch so the file contents are deterministic.
+        lines = ["{},{}".format(BranchTracker._VERSION_ROW_ID, self._version)]
+        for child in sorted(self._child_to_parent):
+            parent = self._child_to_parent[child]
+            base = self._branch_to_base[child]
+            rebase_base = self._branch_to_rebase_base[child] or ""
+            is_archived = self._is_branch_archived[child]
+            # The reader assumes an unquoted fixed-column format, so a comma in any
+            # field would silently corrupt the file on the next load.
+            for field in (child, parent, base, rebase_base):
+                assert "," not in field, \
+                    "Cannot store value containing a comma: {!r}".format(field)
+            lines.append("{},{},{},{},{}".format(child, parent, base, rebase_base, is_archived))
         with open(tmp_config_file, "w") as f:
-            writer = csv.writer(f)
-            writer.writerow([BranchTracker._VERSION_ROW_ID, self._version])
-            for child, parent in self._child_to_parent.items():
-                bases = self._branch_to_bases[child]
-                if len(bases) == 1:
-                    base = bases[0]
-                    rebase_base = ""
-                else:
-                    base, rebase_base = bases
-                is_archived = self._is_branch_archived[child]
-                writer.writerow([child, parent, base, rebase_base, is_archived])
-        shutil.move(tmp_config_file, self._config_file)
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        # Atomically replace the old file with a single rename syscall, avoiding
+        # shutil.move's stat calls and copy fallback. os.replace is the Python 3 spelling
+        # that also overwrites on Windows; Python 2 falls back to plain os.rename.
+        getattr(os, "replace", os.rename)(tmp_config_file, self._config_file)
 
     def parent_for_child(self, child):
         # type: (Text) -> Text
         return self._child_to_parent[child]
 
     def children_for_parent(self, parent):
-        # type: (Text) -> List[Text]
+        # type: (Text) -> AbstractSet[Text]
+        # This is the live underlying set, returned without copying; callers must treat
+        # it as read-only and sort it themselves if they need a deterministic order.
         return self._parent_to_children[parent]
 
     def base_for_branch(self, branch):
         # type: (Text) -> Text
-        bases = self._branch_to_bases[branch]
-        if len(bases) == 1:
+        first_base = self._branch_to_base[branch]
+        second_base = self._branch_to_rebase_base[branch]
+        if second_base is None:
             # If we have one base, just return that.
-            return bases[0]
-        elif len(bases) == 2:
-            # If we started a rebase, figure out what state we're currently in and and return
-            # the actual base accordingly.
-            first_base, second_base = bases
-            has_first_base = does_branch_contain_commit(branch, first_base)
-            has_second_base = does_branch_contain_commit(branch, second_base)
-            # Should have at least one of the two bases
-            assert has_first_base or has_second_base
-            if has_first_base and has_second_base:
-                # Choose the newer one. The older one will be the merge base of the two
-                older_base = git("merge-base {} {}".format(first_base, second_base))
-                first_is_newer = older_base == second_base
-                base = first_base if first_is_newer else second_base
-            else:
-                # Only has one, choose the one that it does have
-                base = bases[0] if has_first_base else bases[1]
-            self.finish_rebase(branch, base)
-            return base
+            return first_base
+        # If we started a rebase, figure out what state we're currently in and and return
+        # the actual base accordingly.
+        has_first_base = does_branch_contain_commit(branch, first_base)
+        has_second_base = does_branch_contain_commit(branch, second_base)
+        # Should have at least one of the two bases
+        assert has_first_base or has_second_base
+        if has_first_base and has_second_base:
+            # Choose the newer one. The older one will be the merge base of the two
+            older_base = git("merge-base {} {}".format(first_base, second_base))
+            first_is_newer = older_base == second_base
+            base = first_base if first_is_newer else second_base
         else:
-            raise AssertionError(
-                "Expected to have 1 or 2 bases, actually had {}".format(len(bases))
-            )
+            # Only has one, choose the one that it does have
+            base = first_base if has_first_base else second_base
+        self.finish_rebase(branch, base)
+        return base
 
     def get_all_parents(self):
         # type: () -> Iterable[Text]
-        return self._parent_to_children.keys()
+        # An iterator rather than keys(), which materializes a whole list on Python 2.
+        return iter(self._parent_to_children)
 
     def has_parent(self, branch):
         # type: (Text) -> bool
@@ -290,48 +401,55 @@ class BranchTracker(object):
 
     def collapse_and_remove_parent(self, old_parent):
         # type: (Text) -> None
+        self._dirty = True
         # Remove the old parent from its parent, use that as the new parent
         new_parent = self._child_to_parent.pop(old_parent)
         self._parent_to_children[new_parent].remove(old_parent)
 
         # Remove the old parent's base branches
-        self._branch_to_bases.pop(old_parent)
+        self._branch_to_base.pop(old_parent)
+        self._branch_to_rebase_base.pop(old_parent)
 
         # Update the old parent's children to point to the new parent
         if old_parent in self._parent_to_children:
             children = self._parent_to_children.pop(old_parent)
-            self._parent_to_children[new_parent].extend(children)
+            self._parent_to_children[new_parent].update(children)
             for child in children:
                 self._child_to_parent[child] = new_parent
 
     def add_child_for_parent(self, parent, new_child, child_base):
         # type: (Text, Text, Text) -> None
+        self._dirty = True
         self._child_to_parent[new_child] = parent
-        self._parent_to_children[parent].append(new_child)
-        self._branch_to_bases[new_child] = (child_base, )
+        self._parent_to_children[parent].add(new_child)
+        self._branch_to_base[new_child] = child_base
+        self._branch_to_rebase_base[new_child] = None
         self._is_branch_archived[new_child] = False
 
     def start_rebase(self, branch, new_base):
         # type: (Text, Text) -> None
-        bases = self._branch_to_bases[branch]
-        assert len(bases) == 1
-        self._branch_to_bases[branch] = bases + (new_base, )
+        self._dirty = True
+        assert self._branch_to_rebase_base[branch] is None
+        self._branch_to_rebase_base[branch] = new_base
 
     def finish_rebase(self, branch, new_base):
         # type: (Text, Text) -> None
-        bases = self._branch_to_bases[branch]
-        assert len(bases) == 2
-        self._branch_to_bases[branch] = (new_base, )
+        self._dirty = True
+        assert self._branch_to_rebase_base[branch] is not None
+        self._branch_to_base[branch] = new_base
+        self._branch_to_rebase_base[branch] = None
 
     def rename_branch(self, old_branch, new_branch):
         # type: (Text, Text) -> None
-        self._branch_to_bases[new_branch] = self._branch_to_bases.pop(old_branch)
+        self._dirty = True
+        self._branch_to_base[new_branch] = self._branch_to_base.pop(old_branch)
+        self._branch_to_rebase_base[new_branch] = self._branch_to_rebase_base.pop(old_branch)
         self._is_branch_archived[new_branch] = self._is_branch_archived.pop(old_branch)
 
         if old_branch in self._child_to_parent:
             parent = self._child_to_parent[new_branch] = self._child_to_parent.pop(old_branch)
             self._parent_to_children[parent].remove(old_branch)
-            self._parent_to_children[parent].append(new_branch)
+            self._parent_to_children[parent].add(new_branch)
 
         if old_branch in self._parent_to_children:
             children = self._parent_to_children[new_branch] = self._parent_to_children.pop(old_branch)
@@ -345,20 +463,23 @@ class BranchTracker(object):
             len(children))
 
         if child_leaf in self._child_to_parent:
+            self._dirty = True
             parent = self._child_to_parent.pop(child_leaf)
             self._parent_to_children[parent].remove(child_leaf)
 
     def set_parent(self, child, new_parent):
         # type: (Text, Text) -> None
+        self._dirty = True
         if child in self._child_to_parent:
             old_parent = self._child_to_parent[child]
             self._parent_to_children[old_parent].remove(child)
 
         self._child_to_parent[child] = new_parent
-        self._parent_to_children[new_parent].append(child)
+        self._parent_to_children[new_parent].add(child)
 
     def set_is_archived(self, branch, is_archived):
         # type: (Text, bool) -> None
+        self._dirty = True
         self._is_branch_archived[branch] = is_archived
 
     def is_archived(self, branch):
@@ -366,6 +487,80 @@ class BranchTracker(object):
         return self._is_branch_archived[branch]
 
 
+# Long-lived `git cat-file --batch-check` process used to resolve revisions without
+# paying fork+exec+git startup for each one. Stopped whenever the caches are cleared,
+# since a fresh git process is the only reliable way to see refs that have moved.
+_cat_file_proc = None  # type: Optional[Any]
+
+
+def _get_cat_file_proc():
+    # type: () -> Optional[Any]
+    global _cat_file_proc
+    if _cat_file_proc is None:
+        try:
+            _cat_file_proc = subprocess.Popen(
+                ["git", "cat-file", "--batch-check=%(objectname)"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        except (OSError, EnvironmentError):
+            return None
+    return _cat_file_proc
+
+
+def _stop_cat_file_proc():
+    # type: () -> None
+    global _cat_file_proc
+    if _cat_file_proc is not None:
+        try:
+            # Closing stdin makes cat-file exit cleanly on EOF.
+            _cat_file_proc.stdin.close()
+            _cat_file_proc.stdout.close()
+            _cat_file_proc.wait()
+        except (IOError, OSError):
+            pass
+        _cat_file_proc = None
+
+
+atexit.register(_stop_cat_file_proc)
+
+
+def _resolve_revs(revs):
+    # type: (List[Text]) -> List[Text]
+    proc = _get_cat_file_proc()
+    if proc is not None:
+        lines = []  # type: List[Text]
+        try:
+            proc.stdin.write("".join(rev + "\n" for rev in revs).encode())
+            proc.stdin.flush()
+            for _ in revs:
+                lines.append(proc.stdout.readline().decode().strip())
+        except (IOError, OSError, ValueError):
+            # The worker died (or was never usable); throw it away and fall back.
+            _stop_cat_file_proc()
+            lines = []
+        # A resolved rev is a bare hash; anything with a space is a "<rev> missing"
+        # response. Fall back to rev-parse in that case so the failure is reported the
+        # same way as every other failed git command.
+        if len(lines) == len(revs) and all(line and " " not in line for line in lines):
+            return lines
+    hashes = git("rev-parse " + " ".join(revs)).strip().split("\n")
+    assert len(hashes) == len(revs), "Expected one hash per rev from `git rev-parse`"
+    return hashes
+
+
 def hash_for(rev):
     # type: (Text) -> Text
-    return git("rev-parse --verify {}".format(rev)).strip()
+    return hash_for_many([rev])[0]
+
+
+def hash_for_many(revs):
+    # type: (Sequence[Text]) -> List[Text]
+    """Resolves several revisions to commit hashes without spawning a git per rev."""
+    missing = []  # type: List[Text]
+    for rev in revs:
+        if rev not in _rev_to_hash and rev not in missing:
+            missing.append(rev)
+    if missing:
+        _rev_to_hash.update(zip(missing, _resolve_revs(missing)))
+    return [_rev_to_hash[rev] for rev in revs]
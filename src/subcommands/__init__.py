@@ -11,7 +11,7 @@ from subcommands.print_child_branch_structure import PrintChildBranchStructure
 from subcommands.set_branch_archived import SetBranchArchived
 
 if False:
-    from typing import Sequence, Set, Text
+    from typing import Optional, Sequence, Set, Text
 
 _ALL_COMMANDS = (
     ArcDiffAgainstParent(),
@@ -27,11 +27,17 @@ _ALL_COMMANDS = (
 )
 
 
+_sorted_commands = None  # type: Optional[Sequence[_BaseCommand]]
+
+
 def get_commands():
     # type: () -> Sequence[_BaseCommand]
-    seen_command_names = set()  # type: Set[Text]
-    for subcommand in _ALL_COMMANDS:
-        subcommand_name = subcommand.get_name()
-        assert subcommand_name not in seen_command_names, "Duplicate command name: {}".format(subcommand_name)
-        seen_command_names.add(subcommand_name)
-    return sorted(_ALL_COMMANDS, key=lambda cmd: cmd.get_name())
+    global _sorted_commands
+    if _sorted_commands is None:
+        seen_command_names = set()  # type: Set[Text]
+        for subcommand in _ALL_COMMANDS:
+            subcommand_name = subcommand.get_name()
+            assert subcommand_name not in seen_command_names, "Duplicate command name: {}".format(subcommand_name)
+            seen_command_names.add(subcommand_name)
+        _sorted_commands = sorted(_ALL_COMMANDS, key=lambda cmd: cmd.get_name())
+    return _sorted_commands
@@ -8,6 +8,7 @@ from git_helpers import (
     get_current_branch,
     git,
     hash_for,
+    hash_for_many,
     run_command_expecting_failure)
 from subcommands.base_command import BaseCommand
 
@@ -70,13 +71,28 @@ def rebase_children(is_recursive, extra_git_rebase_args=tuple()):
         extra_args = ""
 
     with get_branch_tracker() as tracker:
+        # Resolve every branch we may touch with one batched rev-parse up front. When
+        # everything is already rebased (the common re-run case) no branch moves, so all
+        # later hash_for calls are served from this single spawn; as soon as a real
+        # rebase runs, the cache is invalidated and lookups re-resolve as usual.
+        rebase_candidates = [tracker.parent_for_child(current_branch), current_branch]
+        if is_recursive:
+            frontier = [current_branch]
+            while frontier:
+                branch = frontier.pop()
+                for child in sorted(tracker.children_for_parent(branch)):
+                    rebase_candidates.append(child)
+                    frontier.append(child)
+        hash_for_many(rebase_candidates)
+
         do_rebase(tracker, tracker.parent_for_child(current_branch), current_branch, extra_args)
 
         if is_recursive:
             to_rebase_onto = [current_branch]
             while to_rebase_onto:
                 parent = to_rebase_onto.pop()
-                children = tracker.children_for_parent(parent)
+                # Sorted so the rebase order is deterministic.
+                children = sorted(tracker.children_for_parent(parent))
                 for child in children:
                     do_rebase(tracker, parent, child, extra_args)
                     to_rebase_onto.append(child)